@@ -38,7 +38,7 @@
 # segments is returned.
 #
 # Requires:
-# apt-get install autotrace python-pil
+# apt-get install autotrace python-pil python3-numpy
 #
 # 2016-05-10 jw, V0.1 -- initial draught
 # 2016-05-11 jw, V0.2 -- first usable inkscape-extension
@@ -67,23 +67,44 @@
 __version__ = '0.9'    # Keep in sync with centerline-trace.inx ca. line 3 and 24
 __author__ = 'Juergen Weigert <juergen@fabmail.org>'
 
-import sys, os, re, math, tempfile, subprocess, base64, time
+import sys, os, io, re, math, tempfile, subprocess, base64, time, hashlib, json
+import concurrent.futures, threading
 import argparse
 
 try:
     from PIL import Image
     from PIL import ImageOps
-    from PIL import ImageStat
     from PIL import ImageFilter
 except Exception:
     print("Error: Cannot import PIL. Try\n  apt-get install python-pil", file=sys.stderr)
     sys.exit(1)
 
+try:
+    import numpy as np
+except Exception:
+    print("Error: Cannot import numpy. Try\n  apt-get install python3-numpy", file=sys.stderr)
+    sys.exit(1)
+
+# optional: faster image filters. We fall back to PIL without them.
+try:
+    import cv2
+except Exception:
+    cv2 = None
+try:
+    from scipy import ndimage
+except Exception:
+    ndimage = None
+
 debug = False
 # debug = True
 
 autotrace_exe = 'autotrace'
 
+# used for every candidate, compile them only once.
+_RE_Z = re.compile(r'z\s*$')                          # closepath at the end of a subpath
+_RE_PATH_D = re.compile(r'<path[^>]*\bd="([^"]+)"')   # d attribute of a path in autotrace svg output
+_RE_DATA_IMAGE = re.compile(r'data:image/([^;,]+)[^,]*;base64,')   # prefix of an embedded image href
+
 # search path, so that inkscape libraries are found when we are standalone.
 sys_platform = sys.platform.lower()
 if sys_platform.startswith('win'):  # windows
@@ -131,6 +152,83 @@ def uutounit(self, nn, uu):
     except Exception:
         return inkex.uutounit(nn, uu)      # inkscape 0.48
 
+def clamp(v, lo, hi):
+    """ limit v to the range lo..hi """
+    return lo if v < lo else hi if v > hi else v
+
+def median_filter(im, size):
+    """
+    Apply a median filter with an odd kernel size to a graymap image.
+    OpenCV or SciPy are used when available, PIL's MedianFilter is very slow with kernels beyond 3x3.
+    """
+    if cv2 is not None:
+        return Image.fromarray(cv2.medianBlur(np.asarray(im, dtype=np.uint8), size))
+    if ndimage is not None:
+        return Image.fromarray(ndimage.median_filter(np.asarray(im, dtype=np.uint8), size=size, mode='nearest'))
+    return im.filter(ImageFilter.MedianFilter(size=size))
+
+def equal_light(arr, alpha, show=False):
+    """
+    Equalize spatial illumination of a graymap array (my own algorithm):
+    Blend the image with an inverted, strongly blurred copy of itself, using weight alpha for the copy.
+    The blur is done on a 0.01 MP thumbnail. OpenCV does the resize, blur and blend in a few
+    vectorized passes; without OpenCV the same is done with PIL. The two differ by a few gray levels,
+    mostly because PIL approximates the Gaussian with box blurs, so traces may differ slightly between them.
+    """
+    h, w = arr.shape
+    scale_thumb = math.sqrt(w * h * 0.0001)   # exactly 0.01 MP (e.g. 100x100)
+    thumb_size = (max(1, int(w / scale_thumb)), max(1, int(h / scale_thumb)))
+    if cv2 is not None:
+        thumb = cv2.resize(arr, thumb_size, interpolation=cv2.INTER_AREA)
+        thumb = cv2.GaussianBlur(thumb, (0, 0), sigmaX=30, borderType=cv2.BORDER_REPLICATE)
+        neg_blur = cv2.resize(255 - thumb, (w, h), interpolation=cv2.INTER_LINEAR)
+        if show:
+            Image.fromarray(neg_blur).show()
+        return ((1 - alpha) * arr + alpha * neg_blur).astype(np.uint8)
+
+    im = Image.fromarray(arr)
+    im_neg_thumb = ImageOps.invert(im.resize(thumb_size, resample=Image.BILINEAR))
+    im_neg_thumb = im_neg_thumb.filter(ImageFilter.GaussianBlur(radius=30))
+    im_neg_blur = im_neg_thumb.resize(im.size, resample=Image.BILINEAR)
+    im_neg_thumb.close()
+    if show:
+        im_neg_blur.show()
+    im = Image.blend(im, im_neg_blur, alpha)
+    im_neg_blur.close()
+    return np.asarray(im)
+
+def otsu_threshold(arr):
+    """
+    Otsu's method: find the threshold that maximizes the between-class variance of the histogram of
+    a graymap array. Returned in pbm_pack() convention, i.e. pixels below the threshold are black.
+    """
+    hist = np.bincount(arr.ravel(), minlength=256).astype(np.float64)
+    omega = np.cumsum(hist) / hist.sum()                        # weight of the dark class at levels 0..t
+    mu = np.cumsum(hist * np.arange(256)) / hist.sum()          # its first moment
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sigma_b = (mu[-1] * omega - mu) ** 2 / (omega * (1. - omega))
+    t = int(np.argmax(np.nan_to_num(sigma_b, nan=0., posinf=0.)))
+    return min(t + 1, 255)
+
+def pbm_pack(arr, thresholds):
+    """
+    Threshold a graymap array at all thresholds in a single pass and pack the results to
+    PBM P4 payloads. Returns a uint8 array of shape (len(thresholds), height, (width+7)//8).
+    Pixels darker than the threshold become 1 (black); rows are padded to full bytes.
+    The image is processed in row blocks to keep the temporary boolean tensor small.
+    """
+    thresholds = np.asarray(thresholds, dtype=np.uint8)
+    pad = (-arr.shape[1]) % 8
+    if pad:
+        # pad once with white to full bytes, so that packbits never has to pad a row itself.
+        arr = np.pad(arr, ((0, 0), (0, pad)), constant_values=255)
+    h, w = arr.shape
+    packed = np.empty((len(thresholds), h, w // 8), dtype=np.uint8)
+    rows = max(1, (1 << 24) // max(1, len(thresholds) * w))
+    for r in range(0, h, rows):
+        packed[:, r:r + rows] = np.packbits(arr[None, r:r + rows] < thresholds[:, None, None], axis=2)
+    return packed
+
 class TraceCenterline(inkex.Effect):
     """
     Inkscape Extension make long continuous paths from smaller parts
@@ -140,6 +238,9 @@ class TraceCenterline(inkex.Effect):
         super().__init__()
 
         self.dumpname = os.path.join(tempfile.gettempdir(), "trace-centerline.dump")
+        # traced results, see cache_key(). Per user, a shared temp directory would let others plant results.
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache')
+        self.cachedir = os.path.join(cache_home, "centerline-trace")
         self.autotrace_opts = []         # extra options for autotrace tuning.
         self.megapixel_limit = 2.0        # max image size (limit needed, as we have no progress indicator)
         self.invert_image = False         # True: trace bright lines.
@@ -147,6 +248,11 @@ class TraceCenterline(inkex.Effect):
         self.candidates = 15              # [1..255] Number of autotrace candidate runs.
         self.filter_median = 0            # 0 to disable median filter.
         self.filter_equal_light = 0.0     # [0.0 .. 1.9] Use 1.0 with photos. Use 0.0 with perfect scans.
+        self.filter_clahe = False         # True: adaptive histogram equalization instead of autocontrast and equal_light. Needs OpenCV.
+        self.fast = False                 # True: at most 3 candidates around Otsu's threshold.
+        self.fast_sweep = False           # True: run the candidates at half size, only the winner at full size.
+        self.max_seconds = 0              # Time limit for the autotrace runs. 0 for no limit.
+        self.prune = True                 # True: skip candidates that (heuristically) cannot beat the best so far.
         self.hairline = False             # Fixed linewidth.
         self.hairline_width = 0.1         # Width of hairline [mm]
 
@@ -162,6 +268,9 @@ class TraceCenterline(inkex.Effect):
                 print("NOTE: This build of autotrace is incompatible with your system, try a different build.\n", file=sys.stderr)
             print("You need to install autotrace for this extension to work. Try https://github.com/jnweiger/autotrace/releases or search for autotrace version 0.40.0 or later.", file=sys.stderr)
             sys.exit(1)
+        self.autotrace_version = out.strip().decode(errors='replace')
+        self.autotrace_stdin = None       # None: not yet known, False: this autotrace cannot read stdin, use temporary files.
+        self.tty_lock = threading.Lock()  # candidates run in worker threads, keep their messages apart.
 
         try:
             self.tty = open("/dev/tty", 'w')
@@ -197,8 +306,20 @@ class TraceCenterline(inkex.Effect):
         self.arg_parser.add_argument('-e', '--equal-light', action='store',
                                      type=float, default=0.0,
                                      help="Equalize illumination. Use 1.0 with flash photography, use 0.0 to disable.")
+        self.arg_parser.add_argument('--clahe', action='store', type=inkbool, default=False,
+                                     help='Adaptive histogram equalization (CLAHE) instead of autocontrast and equal-light. Needs OpenCV. (Default: off)')
         self.arg_parser.add_argument('-c', '--candidates', action='store',
                                      type=int, default=15, help="[1..255] Autotrace candidate runs. (Lower is much faster)")
+        self.arg_parser.add_argument('-f', '--fast', action='store', type=inkbool, default=False,
+                                     help="Try at most 3 candidates around Otsu's threshold. (Default: Sweep all thresholds)")
+        self.arg_parser.add_argument('--fast-sweep', action='store', type=inkbool, default=False,
+                                     help="Run the candidates on a half size image, trace only the best at full size. (Default: off)")
+        self.arg_parser.add_argument('--prune', action='store', type=inkbool, default=True,
+                                     help="Skip candidates that are unlikely to win, judged by their black pixel count. This is a heuristic, "
+                                          "turn it off if results differ between runs. (Default: on)")
+        self.arg_parser.add_argument('--max-seconds', action='store',
+                                     type=int, default=0, help="Time limit for all autotrace runs, 0 for no limit. Candidates that did not start or finish in time are skipped, "
+                                                               "so results may change with machine speed. (Default: 0)")
         self.arg_parser.add_argument('-d', '--despecle', action='store',
                                      type=int, default=0, help="[0..9] Apply median filter for noise reduction. (Default 0, off)")
         self.arg_parser.add_argument('-D', '--debug-show', action='store_const', const=True, default=False, dest='debug',
@@ -217,6 +338,82 @@ class TraceCenterline(inkex.Effect):
     def author(self):
         return __author__
 
+    def cache_key(self, image_file, cliprect=None):
+        """ return a sha1 hexdigest of the image file contents and all settings that influence
+            the result of svg_centerline_trace(). Our version and the autotrace version are included,
+            so that an update does not return stale results.
+        """
+        opts = {
+            'version': __version__,
+            'autotrace': self.autotrace_version,
+            'autotrace_opts': self.autotrace_opts,
+            'at_filter_iterations': self.options.at_filter_iterations,
+            'at_error_threshold': self.options.at_error_threshold,
+            'megapixels': self.megapixel_limit,
+            'invert': self.invert_image,
+            'candidates': self.candidates,
+            'fast': self.fast,
+            'fast_sweep': self.fast_sweep,
+            'prune': self.prune,
+            'despecle': self.filter_median,
+            'equal_light': self.filter_equal_light,
+            'clahe': self.filter_clahe,
+            'cv2': cv2 is not None,
+            'ndimage': ndimage is not None,
+            'cliprect': None if cliprect is None else [cliprect[k] for k in ('x', 'y', 'w', 'h')]
+        }
+        if isinstance(image_file, io.BytesIO):
+            data = image_file.getvalue()
+        else:
+            with open(image_file, 'rb') as f:
+                data = f.read()
+        return hashlib.sha1(data + repr(sorted(opts.items())).encode()).hexdigest()
+
+    def autotrace(self, autotrace_cmd, pbm, timeout=None):
+        """ run autotrace_cmd on the PBM image data pbm and return the svg output as a string.
+            The image is piped through stdin. If that fails, we retry with a temporary file.
+            Only if the temporary file works where stdin never did, we use temporary files
+            for all later calls. A bitmap that autotrace cannot handle fails both ways.
+            autotrace is killed after timeout seconds, then None is returned.
+        """
+        stdin_failed = False
+        if self.autotrace_stdin is not False:
+            p = subprocess.Popen(autotrace_cmd + ['-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                svg = p.communicate(pbm, timeout=timeout)[0].decode()
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.communicate()
+                return None
+            if len(svg):
+                self.autotrace_stdin = True
+                return svg
+            stdin_failed = True
+
+        fp = tempfile.NamedTemporaryFile(prefix="centerlinetrace", suffix='.pbm', delete=False)
+        fp.write(pbm)
+        fp.close()
+        p = subprocess.Popen(autotrace_cmd + [fp.name], stdout=subprocess.PIPE)
+        try:
+            svg = p.communicate(timeout=timeout)[0].decode()
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            os.unlink(fp.name)
+            return None
+        if not len(svg):
+            with self.tty_lock:
+                print("autotrace_cmd: " + ' '.join(autotrace_cmd + [fp.name]), file=sys.stderr)
+                print("ERROR: returned nothing, leaving tmp bmp file around for you to debug", file=sys.stderr)
+            return '<svg/>'
+        os.unlink(fp.name)
+        if stdin_failed and self.autotrace_stdin is None:
+            if debug:
+                with self.tty_lock:
+                    print("autotrace cannot read stdin, using temporary files", file=self.tty)
+            self.autotrace_stdin = False
+        return svg
+
     def svg_centerline_trace(self, image_file, cliprect=None):
         """
         svg_centerline_trace prepares the image by
@@ -224,13 +421,30 @@ class TraceCenterline(inkex.Effect):
         b) removing noise,
         c) linear histogram expansion,
         d) equalized spatial illumnination (my own algorithm)
+        or alternatively c+d) adaptive histogram equalization (CLAHE, needs OpenCV)
 
         Then we run several iterations of autotrace and find the optimal black white threshold by evaluating
         all outputs. The output with the longest total path and the least path elements wins.
+        In fast mode, only up to 3 thresholds around Otsu's threshold are tried.
+        With fast_sweep, the candidates run on a half size image and only the winner is traced at full size.
 
         A cliprect dict with the keys x, y, w, h can be specified. All 4 are expected in the
         range 0..1 and are mapped to the image width and height.
+
+        image_file is a file name, or an io.BytesIO with the image data of an embedded image.
+        Results are cached in self.cachedir, so that re-running with the same image and settings is instant.
         """
+        cache_file = None
+        if not self.options.debug:
+            cache_file = os.path.join(self.cachedir, self.cache_key(image_file, cliprect) + '.json')
+            try:
+                with open(cache_file) as f:
+                    svg, strokewidth, im_size = json.load(f)
+                if debug:
+                    print("svg_centerline_trace cached " + cache_file, file=self.tty)
+                return (svg, strokewidth, tuple(im_size))
+            except Exception:
+                pass
         num_attempts = self.candidates  # 15 is great. min 1, max 255, beware it gets much slower with more attempts.
         autotrace_cmd = [autotrace_exe,
                          '--filter-iterations', str(self.options.at_filter_iterations),
@@ -243,7 +457,7 @@ class TraceCenterline(inkex.Effect):
         stroke_style_add = 'stroke-width:%.2f; fill:none; stroke-linecap:round;'
 
         if debug:
-            print("svg_centerline_trace start " + image_file, file=self.tty)
+            print("svg_centerline_trace start " + str(image_file), file=self.tty)
             print('+ ' + ' '.join(autotrace_cmd), file=self.tty)
         im = Image.open(image_file)
         orig_im_size = (im.size[0], im.size[1])
@@ -251,18 +465,18 @@ class TraceCenterline(inkex.Effect):
         if cliprect is not None:
             box[0] = cliprect['x'] * im.size[0]
             box[1] = cliprect['y'] * im.size[1]
-            # sorted(min, val, max)[1] does clamping without chaining min(max()) in an ugly way.
-            box[2] = sorted((0, int(0.5 + box[0] + cliprect['w'] * im.size[0]), im.size[0]))[1]
-            box[3] = sorted((0, int(0.5 + box[1] + cliprect['h'] * im.size[1]), im.size[1]))[1]
-            box[0] = sorted((0, int(0.5 + box[0]), im.size[0]))[1]
-            box[1] = sorted((0, int(0.5 + box[1]), im.size[1]))[1]
+            box[2] = clamp(int(0.5 + box[0] + cliprect['w'] * im.size[0]), 0, im.size[0])
+            box[3] = clamp(int(0.5 + box[1] + cliprect['h'] * im.size[1]), 0, im.size[1])
+            box[0] = clamp(int(0.5 + box[0]), 0, im.size[0])
+            box[1] = clamp(int(0.5 + box[1]), 0, im.size[1])
             im = im.crop(box)
             if box[0] == box[2] or box[1] == box[3]:
                 print("ERROR: Cliprect and Image do not overlap.", orig_im_size, box, cliprect, file=sys.stderr)
                 return ('<svg/>', 1, orig_im_size)
 
-        if 'A' in im.mode:
+        if 'A' in im.mode and im.getchannel('A').getextrema()[0] < 255:
             # this image has alpha. Paste it onto white or black.
+            # Fully opaque alpha is common, the convert to 'L' below simply drops it.
             im = im.convert("RGBA")
             if self.invert_image:
                 bg = Image.new('RGBA', im.size, (0, 0, 0, 255))  # black background
@@ -287,24 +501,28 @@ class TraceCenterline(inkex.Effect):
         if self.filter_median > 0:
             if self.filter_median % 2 == 0:
                 self.filter_median = self.filter_median + 1    # need odd values.
-            im = im.filter(ImageFilter.MedianFilter(size=self.filter_median))  # feeble denoise attempt. FIXME: try ROF instead.
-        im = ImageOps.autocontrast(im, cutoff=0)  # linear expand histogram (an alternative to equalize)
-        ## cutoff=2 destroys some images, see https://github.com/fablabnbg/inkscape-centerline-trace/issues/28
-
-        if self.filter_equal_light > 0.0:
-            scale_thumb = math.sqrt(im.size[0] * im.size[1] * 0.0001)   # exactly 0.01 MP (e.g. 100x100)
-            im_neg_thumb = ImageOps.invert(im.resize((int(im.size[0] / scale_thumb), int(im.size[1] / scale_thumb)), resample=Image.BILINEAR))
-            im_neg_thumb = im_neg_thumb.filter(ImageFilter.GaussianBlur(radius=30))
-            im_neg_blur = im_neg_thumb.resize(im.size, resample=Image.BILINEAR)
-            if self.options.debug:
-                im_neg_blur.show()
-
+            im = median_filter(im, self.filter_median)  # feeble denoise attempt. FIXME: try ROF instead.
+        if self.filter_clahe and cv2 is None:
+            print("Warning: CLAHE needs OpenCV. Try\n  apt-get install python3-opencv\nUsing autocontrast instead.", file=sys.stderr)
+        if self.filter_clahe and cv2 is not None:
+            # adaptive histogram equalization does both, histogram expansion and equalizing local illumination.
+            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+            im = Image.fromarray(clahe.apply(np.asarray(im, dtype=np.uint8)))
             if debug:
-                print("ImageOps.equalize(im) done", file=self.tty)
-            im = Image.blend(im, im_neg_blur, self.filter_equal_light * 0.5)
-            im = ImageOps.autocontrast(im, cutoff=0)  # linear expand histogram (an alternative to equalize)
+                print("clahe(im) done", file=self.tty)
             if self.options.debug:
                 im.show()
+        else:
+            im = ImageOps.autocontrast(im, cutoff=0)  # linear expand histogram (an alternative to equalize)
+            ## cutoff=2 destroys some images, see https://github.com/fablabnbg/inkscape-centerline-trace/issues/28
+
+            if self.filter_equal_light > 0.0:
+                im = Image.fromarray(equal_light(np.asarray(im, dtype=np.uint8), self.filter_equal_light * 0.5, show=self.options.debug))
+                if debug:
+                    print("equal_light(im) done", file=self.tty)
+                im = ImageOps.autocontrast(im, cutoff=0)  # linear expand histogram (an alternative to equalize)
+                if self.options.debug:
+                    im.show()
 
         def svg_pathstats(path_d):
             """ calculate statistics from an svg path:
@@ -312,75 +530,121 @@ class TraceCenterline(inkex.Effect):
                 points (all, including duplicates)
                 segments (number of not-connected!) path segments.
             """
-            path_d = path_d.lower()
             p_points = 0
             p_length = 0
             p_segments = 0
-            for p in path_d.split('m'):
-                pp = re.sub('[cl,]', ' ', p)
-                pp, closed = re.subn('z\s*$', '', pp)
-                xy = pp.split()
+            # autotrace emits many short subpaths, a plain scalar loop beats numpy per-call overhead here.
+            for p in path_d.lower().replace(',', ' ').replace('c', ' ').replace('l', ' ').split('m'):
+                p, closed = _RE_Z.subn('', p)
+                xy = p.split()
                 if len(xy) < 2:
                     continue
-                x0 = float(xy[0])
-                y0 = float(xy[1])
+                x0 = x = float(xy[0])
+                y0 = y = float(xy[1])
                 p_points += 1
-                x = xy[2::2]
-                y = xy[3::2]
-                if len(x):
+                if len(xy) > 3:
                     p_segments += 1
-                    if closed:
-                        x.extend([x0])
-                        y.extend([y0])
-                for i in range(len(x)):
+                for i in range(2, len(xy) - 1, 2):
+                    xn = float(xy[i])
+                    yn = float(xy[i + 1])
+                    p_length += math.hypot(xn - x, yn - y)
+                    x, y = xn, yn
+                    p_points += 1
+                if closed and len(xy) > 3:
+                    p_length += math.hypot(x0 - x, y0 - y)
                     p_points += 1
-                    dx = float(x[i]) - x0
-                    dy = float(y[i]) - y0
-                    p_length += math.sqrt(dx * dx + dy * dy)
-                    x0, y0 = float(x[i]), float(y[i])
             return {'points': p_points, 'segments': p_segments, 'length': p_length}
 
         candidate = {}
         if self.options.debug:
             im.show()
 
-        for i in range(num_attempts):
-            threshold = int(256. * (1 + i) / (num_attempts + 1))
-            # make lookup table that maps to black/white using threshold.
-            lut = [255 for n in range(threshold)] + [0 for n in range(threshold, 256)]
-            if debug:
-                print("attempt " + str(i), file=self.tty)
-            bw = im.point(lut, mode='1')
+        arr = np.asarray(im, dtype=np.uint8)
+        im_mean = float(arr.mean())     # im is the same for all candidates.
+        if self.fast:
+            # Otsu gives a near optimal threshold from the histogram alone. Only try a small sweep around it.
+            otsu = otsu_threshold(arr)
+            num_attempts = min(num_attempts, 3)
+            thresholds = [clamp(otsu + 8 * (2 * i + 1 - num_attempts) // 2, 1, 255) for i in range(num_attempts)]
+        else:
+            thresholds = [int(256. * (1 + i) / (num_attempts + 1)) for i in range(num_attempts)]
+        full_arr = None
+        sweep_scale = 1.    # size factor from the swept image back to full size, see calc_weight()
+        if self.fast_sweep and num_attempts > 1:
+            # The candidates only need to find the best threshold, half size is good enough for that.
+            # With a single threshold there is nothing to choose, the extra full size trace would only cost time.
+            full_arr = arr
+            sweep_scale = 2.
+            arr = np.array(im.resize((max(1, im.size[0] // 2), max(1, im.size[1] // 2)), resample=Image.BILINEAR), dtype=np.uint8)
+            arr[[0, -1], :] = 255   # restore the one pixel padding, the resize blurred it.
+            arr[:, [0, -1]] = 255
+        im.close()          # arr has its own copy of the pixels.
+        del im
+        packed = pbm_pack(arr, thresholds)
+        black_counts = np.cumsum(np.bincount(arr.ravel(), minlength=256))  # black_counts[t-1]: pixels below threshold t
+        if debug:
+            print("pbm_pack done: thresholds=%s" % thresholds, file=self.tty)
+
+        def calc_weight(cand, idx):
+            # length, points and offset grow with the image size, segments don't. Scale the former
+            # back to full size, so that a half size sweep weighs segments as a full size one would.
+            offset = (num_attempts / 2. - idx) * (num_attempts / 2. - idx) * (cand['img_width'] + cand['img_height'])
+            w = (cand['length'] * 5 - offset * .005 - cand['points'] * .2) * sweep_scale - cand['segments'] * 20
+            return w
+
+        def calc_weight_bound(idx):
+            """ estimated upper bound for calc_weight() before running autotrace, from the number of black pixels.
+                This is a heuristic, not a proven bound: we assume a centerline is at most 2 units long per
+                black pixel. A one pixel wide diagonal stroke has sqrt(2) per pixel, measuring bezier splines
+                through their handles adds some more, 2 leaves headroom for that. autotrace's curve fitting
+                can still exceed it, then a skipped candidate might have won. Use --prune=false to avoid that.
+                A path has at least one segment, an empty result only has the offset.
+            """
+            black = int(black_counts[thresholds[idx] - 1])
+            offset = (num_attempts / 2. - idx) * (num_attempts / 2. - idx) * (arr.shape[1] + arr.shape[0])
+            return max(black * 2 * 5 * sweep_scale - 20, 0) - offset * .005 * sweep_scale
+
+        best = {'weight': None}     # best weight seen so far, shared by all worker threads.
+        best_lock = threading.Lock()
+        incomplete = []             # candidates that were skipped or killed by the time limit.
+
+        def run_candidate(i):
+            threshold = thresholds[i]
             if debug:
-                print("bw from lut done: threshold=%d" % threshold, file=self.tty)
+                with self.tty_lock:
+                    print("attempt " + str(i), file=self.tty)
             if self.options.debug:
-                bw.show(command="/usr/bin/display -title=bw:threshold=%d" % threshold)
-            cand = {'threshold': threshold, 'img_width': bw.size[0], 'img_height': bw.size[1], 'mean': ImageStat.Stat(im).mean[0]}
-            fp = tempfile.NamedTemporaryFile(prefix="centerlinetrace", suffix='.pbm', delete=False)
-            fp.write(("P4\n%d %d\n" % (bw.size[0], bw.size[1])).encode())
-            fp.write(bw.tobytes())
-            fp.close()
-            if debug:
-                print("pbm from bw done", file=self.tty)
-            p = subprocess.Popen(autotrace_cmd + [fp.name], stdout=subprocess.PIPE)
-            cand['svg'] = p.communicate()[0].decode()
-            if debug:
-                print("autotrace done", file=self.tty)
-            if not len(cand['svg']):
-                print("autotrace_cmd: " + ' '.join(autotrace_cmd + [fp.name]), file=sys.stderr)
-                print("ERROR: returned nothing, leaving tmp bmp file around for you to debug", file=sys.stderr)
+                bits = np.unpackbits(packed[i], axis=1, count=arr.shape[1])
+                Image.fromarray(bits == 0).show(command="/usr/bin/display -title=bw:threshold=%d" % threshold)
+            cand = {'threshold': threshold, 'img_width': arr.shape[1], 'img_height': arr.shape[0], 'mean': im_mean}
+            if self.prune and best['weight'] is not None and calc_weight_bound(i) < best['weight']:
+                # this candidate is very unlikely to win, don't waste an autotrace run on it.
+                if debug:
+                    with self.tty_lock:
+                        print("attempt %d skipped: bound %g < best %g" % (i, calc_weight_bound(i), best['weight']), file=self.tty)
+                cand['svg'] = '<svg/>'
+            elif self.max_seconds > 0 and time.monotonic() - start > self.max_seconds:
+                # out of time, see --max-seconds. Pick the best of those that completed.
+                incomplete.append(i)
                 cand['svg'] = '<svg/>'
             else:
-                os.unlink(fp.name)
-            try:
-                xml = inkex.etree.fromstring(cand['svg'])
-            except Exception:
-                print("autotrace_cmd: " + ' '.join(autotrace_cmd + [fp.name]), file=sys.stderr)
-                print("ERROR: no proper xml returned: '" + cand['svg'] + "'", file=sys.stderr)
-                xml = inkex.etree.fromstring('<svg/>')
+                pbm = b"P4\n%d %d\n" % (arr.shape[1], arr.shape[0]) + packed[i].tobytes()
+                cand['svg'] = self.autotrace(autotrace_cmd, pbm, timeout)
+                if cand['svg'] is None:
+                    incomplete.append(i)
+                    cand['svg'] = '<svg/>'
+                if debug:
+                    with self.tty_lock:
+                        print("autotrace done", file=self.tty)
+            if '<svg' not in cand['svg']:
+                with self.tty_lock:
+                    print("autotrace_cmd: " + ' '.join(autotrace_cmd), file=sys.stderr)
+                    print("ERROR: no proper xml returned: '" + cand['svg'] + "'", file=sys.stderr)
+                cand['svg'] = '<svg/>'
             p_len, p_seg, p_pts = 0, 0, 0
-            for p in xml.findall('path'):
-                pstat = svg_pathstats(p.attrib['d'])
+            # autotrace writes one flat <path .../> per line, no need to build a DOM per candidate.
+            for path_d in _RE_PATH_D.findall(cand['svg']):
+                pstat = svg_pathstats(path_d)
                 p_len += pstat['length']
                 p_seg += pstat['segments']
                 p_pts += pstat['points']
@@ -392,26 +656,75 @@ class TraceCenterline(inkex.Effect):
                 cand['mean'] = 255 - cand['mean']  # should not happen
             blackpixels = cand['img_width'] * cand['img_height'] * cand['mean'] / 255.
             cand['strokewidth'] = blackpixels / max(cand['length'], 1.0)
-            candidate[i] = cand
-
-        def calc_weight(cand, idx):
-            offset = (num_attempts / 2. - idx) * (num_attempts / 2. - idx) * (cand['img_width'] + cand['img_height'])
-            w = cand['length'] * 5 - offset * .005 - cand['points'] * .2 - cand['segments'] * 20
-            return w
+            with best_lock:
+                w = calc_weight(cand, i)
+                if best['weight'] is None or w > best['weight']:
+                    best['weight'] = w
+            return cand
+
+        # Each candidate is an independent autotrace subprocess. Threads are good enough to
+        # keep all cores busy, as they only wait for the subprocess (the GIL is released there).
+        # Middle thresholds go first, they usually win and let calc_weight_bound() skip the extremes.
+        # With several workers, which candidates get skipped depends on timing.
+        order = sorted(range(num_attempts), key=lambda i: abs(i - (num_attempts - 1) / 2.))
+        workers = max(1, min(num_attempts, os.cpu_count() or 1))
+        # A single autotrace run may use its share of the time limit, but never less than 5 seconds.
+        # Large noisy images at extreme thresholds can otherwise keep autotrace busy for minutes.
+        timeout = max(5., self.max_seconds * workers / num_attempts) if self.max_seconds > 0 else None
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            candidate = dict(zip(order, executor.map(run_candidate, order)))
+        packed = arr = None     # free the sweep pixels, the closures above still refer to these names.
+        if incomplete:
+            print("Warning: time limit of %d seconds reached, %d of %d candidates skipped or aborted. (See --max-seconds)" %
+                  (self.max_seconds, len(incomplete), num_attempts), file=sys.stderr)
 
         best_weight_idx = 0
-        for n in candidate.keys():
+        for n in sorted(candidate.keys()):
             if calc_weight(candidate[n], n) > calc_weight(candidate[best_weight_idx], best_weight_idx):
                 best_weight_idx = n
 
         if debug:
             print("best: %d/%d" % (best_weight_idx, num_attempts), file=self.tty)
+        for n in candidate.keys():
+            if n != best_weight_idx:
+                candidate[n] = None     # drop the svg strings of the losers.
+
+        if full_arr is not None:
+            # trace the winning threshold once more at full size.
+            cand = candidate[best_weight_idx]
+            pbm = b"P4\n%d %d\n" % (full_arr.shape[1], full_arr.shape[0]) + pbm_pack(full_arr, [cand['threshold']])[0].tobytes()
+            # only what is left of the time limit, but at least 5 seconds like any other run.
+            timeout = max(5., self.max_seconds - (time.monotonic() - start)) if self.max_seconds > 0 else None
+            cand['svg'] = self.autotrace(autotrace_cmd, pbm, timeout)
+            if cand['svg'] is None:
+                print("Warning: full size autotrace exceeded the time limit of %d seconds. (See --max-seconds)" % self.max_seconds, file=sys.stderr)
+                incomplete.append(best_weight_idx)
+                cand['svg'] = '<svg/>'
+            cand['img_width'], cand['img_height'] = full_arr.shape[1], full_arr.shape[0]
+            cand['length'] = sum(svg_pathstats(path_d)['length'] for path_d in _RE_PATH_D.findall(cand['svg']))
+            blackpixels = cand['img_width'] * cand['img_height'] * cand['mean'] / 255.
+            cand['strokewidth'] = blackpixels / max(cand['length'], 1.0)
+            if debug:
+                print("full size autotrace done: threshold=%d" % cand['threshold'], file=self.tty)
+            del full_arr, pbm
         ## if standalone:
         # svg = re.sub('stroke:', (stroke_style_add % candidate[best_weight_idx]['strokewidth']) + ' stroke:', candidate[best_weight_idx]['svg'])
         # return svg
 
         ## inkscape-extension:
-        return (candidate[best_weight_idx]['svg'], candidate[best_weight_idx]['strokewidth'], orig_im_size)
+        result = (candidate[best_weight_idx]['svg'], candidate[best_weight_idx]['strokewidth'], orig_im_size)
+        # Don't keep time limited results, they depend on the machine. Don't keep failed traces either,
+        # they would stick even after autotrace is fixed.
+        if cache_file is not None and not incomplete and _RE_PATH_D.search(result[0]):
+            try:
+                os.makedirs(self.cachedir, mode=0o700, exist_ok=True)
+                with open(cache_file + '.tmp', 'w') as f:
+                    json.dump(result, f)
+                os.replace(cache_file + '.tmp', cache_file)
+            except Exception as e:
+                print("Warning: cannot write cache " + cache_file + ": " + str(e), file=sys.stderr)
+        return result
 
     def calc_unit_factor(self, units='mm'):
         """ return the scale factor for all dimension conversions.
@@ -441,6 +754,16 @@ class TraceCenterline(inkex.Effect):
             self.filter_median = self.options.despecle
         if self.options.equal_light is not None:
             self.filter_equal_light = self.options.equal_light
+        if self.options.clahe is not None:
+            self.filter_clahe = self.options.clahe
+        if self.options.fast is not None:
+            self.fast = self.options.fast
+        if self.options.fast_sweep is not None:
+            self.fast_sweep = self.options.fast_sweep
+        if self.options.max_seconds is not None:
+            self.max_seconds = self.options.max_seconds
+        if self.options.prune is not None:
+            self.prune = self.options.prune
         if self.options.hairline is not None:
             self.hairline = self.options.hairline
         if self.options.hairline_width is not None:
@@ -517,30 +840,28 @@ class TraceCenterline(inkex.Effect):
             #
             # ######################
 
-            if href[:7] == 'file://':
-                filename = href[7:]
+            # embedded images can be many megabytes, match the prefix once, and slice only once.
+            data_image = _RE_DATA_IMAGE.match(href)
+            if href.startswith('file://'):
+                image_file = href[7:]
                 if debug:
-                    print("linked image: =" + filename, file=self.tty)
-            elif href[0] == '/' or href[0] == '.':
-                filename = href
+                    print("linked image: =" + image_file, file=self.tty)
+            elif href.startswith(('/', '.')):
+                image_file = href
                 if debug:
-                    print("linked image path: =" + filename, file=self.tty)
-            elif href[:11] == 'data:image/':
-                l = href[11:].index(';')
-                img_type = href[11:11+l]   # 'png' or 'jpeg'
+                    print("linked image path: =" + image_file, file=self.tty)
+            elif data_image:
+                img_type = data_image.group(1)   # 'png' or 'jpeg'
                 if debug:
-                    print("embedded image: " + href[:11+l], file=self.tty)
-                img = base64.decodebytes(href[11+l+8:].encode('utf-8'))
-                f = tempfile.NamedTemporaryFile(mode="wb", prefix='centerlinetrace', suffix="." + img_type, delete=False)
-                f.write(img)
-                filename = f.name
-                f.close()
+                    print("embedded image: " + img_type, file=self.tty)
+                # PIL reads from memory just fine, no need for a temporary file.
+                image_file = io.BytesIO(base64.b64decode(href[data_image.end():]))
             else:
                 inkex.errormsg(_("Neither file:// nor data:image/; prefix. Cannot parse PNG/JPEG image href " + href[:200] + "..."))
                 sys.exit(1)
             if debug:
-                print("filename=" + filename, file=self.tty)
-            path_svg, stroke_width, im_size = self.svg_centerline_trace(filename, cliprect)
+                print("image_file=" + str(image_file), file=self.tty)
+            path_svg, stroke_width, im_size = self.svg_centerline_trace(image_file, cliprect)
             xml = inkex.etree.fromstring(path_svg)
             try:
                 path_d = xml.find('path').attrib['d']
@@ -560,8 +881,6 @@ class TraceCenterline(inkex.Effect):
                 svg_x_off = max(svg_x_off, float(cliprect['node'].get('x', 0)))
                 svg_y_off = max(svg_y_off, float(cliprect['node'].get('y', 0)))
             matrix = "translate(%g,%g) scale(%g,%g)" % (svg_x_off, svg_y_off, sx, sy)
-            if href[:5] == 'data:':
-                os.unlink(filename)  # remove temporary file
             if self.hairline:
                 stroke_width = self.hairline_width * 96. / 25.4   # mm2px FIXME: 96dpi is just a default guess.
             else: